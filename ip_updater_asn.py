@@ -3,6 +3,10 @@ import re
 import ipaddress
 import sys
 import time
+import heapq
+import itertools
+import threading
+import queue
 
 # --- config ---
 domains_file = "/config/scripts/vpn_domains_asn.txt"
@@ -10,6 +14,28 @@ ipv4_group_name = "VPN-NETWORKS"
 ipv6_group_name = "VPN-NETWORKS-v6"
 config_path = "/config/config.boot"
 
+# Pipeline tuning. Each stage hands results to the next through a bounded queue,
+# so a slow stage holds back the ones before it instead of letting work pile up.
+queue_size = 64
+dns_workers = 8
+asn_workers = 4
+# Pause between RADB queries so whois.radb.net doesn't throttle us
+radb_delay = 20
+
+# Upper limit on entries per network group. Above this, neighbouring prefixes are merged
+# into supernets even if that covers some extra addresses. None keeps exact aggregation only.
+max_ipv4_entries = None
+max_ipv6_entries = None
+
+# Pipeline stages print from several threads at once, and this output gets
+# sourced by vbash, so anything printed from a worker goes through emit()
+# to keep each line whole.
+_emit_lock = threading.Lock()
+
+def emit(line):
+    with _emit_lock:
+        print(line)
+
 def get_domains_from_file(filepath):
     domains = []
     try:
@@ -37,16 +63,16 @@ def get_ip_from_domain(domain):
         if ips[0]:
             try:
                 ipaddress.ip_address(ips[0])
-                print(f"echo Found IP for {domain}: {ips[0]}")
+                emit(f"echo Found IP for {domain}: {ips[0]}")
                 return ips[0]
             except ValueError:
-                print(f"echo Skipping non-IP address for {domain}: {ips[0]}")
+                emit(f"echo Skipping non-IP address for {domain}: {ips[0]}")
                 return None
 
     except subprocess.CalledProcessError as e:
-        print(f"echo Error during dig lookup for {domain}: {e.stderr}")
+        emit(f"echo Error during dig lookup for {domain}: {e.stderr}")
     except Exception as e:
-        print(f"echo An unexpected error occurred: {e}")
+        emit(f"echo An unexpected error occurred: {e}")
 
     return None
 
@@ -62,19 +88,19 @@ def get_asn_from_ip(ip_address):
             data_line = lines[1]
             parts = data_line.split('|')
             if len(parts) >= 1:
-                print(f"echo Found ASN for {ip_address}: {parts[0].strip()}")
+                emit(f"echo Found ASN for {ip_address}: {parts[0].strip()}")
                 return parts[0].strip()
 
     except subprocess.CalledProcessError as e:
-        print(f"echo Error during whois lookup: {e.stderr}")
+        emit(f"echo Error during whois lookup: {e.stderr}")
     except Exception as e:
-        print(f"echo An unexpected error occurred: {e}")
+        emit(f"echo An unexpected error occurred: {e}")
 
     return None
 
 def get_networks_from_asn(asn):
     max_retries = 2
-    print(f"echo Getting networks for ASN {asn}")
+    emit(f"echo Getting networks for ASN {asn}")
 
     for attempt in range(max_retries + 1):
         try:
@@ -90,38 +116,38 @@ def get_networks_from_asn(asn):
                 route_match = re.search(r"route:\s*(.*)", line)
                 if route_match:
                     details["ipv4_networks"].add(route_match.group(1).strip())
-                    print(f"echo Found ipv4 network: {route_match.group(1).strip()}")
+                    emit(f"echo Found ipv4 network: {route_match.group(1).strip()}")
 
                 route6_match = re.search(r"route6:\s*(.*)", line)
                 if route6_match:
                     details["ipv6_networks"].add(route6_match.group(1).strip())
-                    print(f"echo Found ipv6 network: {route6_match.group(1).strip()}")
+                    emit(f"echo Found ipv6 network: {route6_match.group(1).strip()}")
 
             return details
 
         except subprocess.CalledProcessError as e:
-            print(f"echo Error during RADB lookup: {e.stderr.strip()}")
+            emit(f"echo Error during RADB lookup: {e.stderr.strip()}")
             if attempt < max_retries:
-                print(f"echo Retrying in 10 seconds... (Attempt {attempt + 1}/{max_retries})")
+                emit(f"echo Retrying in 10 seconds... (Attempt {attempt + 1}/{max_retries})")
                 time.sleep(20)
             else:
-                print(f"echo Max retries exceeded. Exiting.")
+                emit(f"echo Max retries exceeded. Exiting.")
 
         except subprocess.TimeoutExpired as e:
-            print(f"echo Command timed out after {e.timeout} seconds.")
+            emit(f"echo Command timed out after {e.timeout} seconds.")
             if attempt < max_retries:
-                print(f"echo Retrying in 10 seconds... (Attempt {attempt + 1}/{max_retries})")
+                emit(f"echo Retrying in 10 seconds... (Attempt {attempt + 1}/{max_retries})")
                 time.sleep(20)
             else:
-                print(f"echo Max retries exceeded. Exiting.")
+                emit(f"echo Max retries exceeded. Exiting.")
 
         except Exception as e:
-            print(f"echo An unexpected error occurred: {e}")
+            emit(f"echo An unexpected error occurred: {e}")
             if attempt < max_retries:
-                print(f"echo Retrying in 10 seconds... (Attempt {attempt + 1}/{max_retries})")
+                emit(f"echo Retrying in 10 seconds... (Attempt {attempt + 1}/{max_retries})")
                 time.sleep(10)
             else:
-                print(f"echo Max retries exceeded. Exiting.")
+                emit(f"echo Max retries exceeded. Exiting.")
 
     return None
 
@@ -152,6 +178,170 @@ def get_current_group_networks(group_name, is_ipv6=False):
 
     return current_items
 
+def build_prefix_tree(networks, parent=None):
+    # networks must be sorted and non-overlapping, e.g. from collapse_addresses
+    first, last = networks[0], networks[-1]
+    if len(networks) == 1:
+        return {"network": first, "parent": parent, "children": None,
+                "covered": first.num_addresses, "leaves": 1, "version": 0}
+
+    # Smallest supernet containing every prefix in this branch
+    differing_bits = (int(first.network_address) ^ int(last.network_address)).bit_length()
+    prefixlen = min(first.prefixlen, last.prefixlen, first.max_prefixlen - differing_bits)
+    supernet = first.supernet(new_prefix=prefixlen)
+    lower_half = next(supernet.subnets())
+    split = 0
+    while networks[split].subnet_of(lower_half):
+        split += 1
+
+    node = {"network": supernet, "parent": parent, "children": None, "version": 0}
+    node["children"] = [build_prefix_tree(networks[:split], node),
+                        build_prefix_tree(networks[split:], node)]
+    node["covered"] = sum(child["covered"] for child in node["children"])
+    node["leaves"] = sum(child["leaves"] for child in node["children"])
+    return node
+
+def push_merge(heap, node, counter):
+    # Cheapest merge first: least extra address space, then most entries saved
+    extra = node["network"].num_addresses - node["covered"]
+    heapq.heappush(heap, (extra, -node["leaves"], next(counter), node["version"], node))
+
+def aggregate_networks(networks, max_entries):
+    networks = list(ipaddress.collapse_addresses(networks))
+    if max_entries is None or len(networks) <= max_entries:
+        return networks, 0
+
+    root = build_prefix_tree(networks)
+    heap = []
+    counter = itertools.count()
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if node["children"]:
+            push_merge(heap, node, counter)
+            stack.extend(node["children"])
+
+    entries = len(networks)
+    extra_addresses = 0
+    while entries > max_entries and heap:
+        extra, _, _, version, node = heapq.heappop(heap)
+        if version != node["version"] or not node["children"]:
+            continue
+
+        # Replace everything under this node with the node's own supernet,
+        # invalidating any queued merges below it
+        stack = list(node["children"])
+        while stack:
+            child = stack.pop()
+            if child["children"]:
+                child["version"] += 1
+                stack.extend(child["children"])
+
+        saved = node["leaves"] - 1
+        node["children"] = None
+        node["covered"] = node["network"].num_addresses
+        node["leaves"] = 1
+        node["version"] += 1
+        entries -= saved
+        extra_addresses += extra
+
+        ancestor = node["parent"]
+        while ancestor is not None:
+            ancestor["covered"] += extra
+            ancestor["leaves"] -= saved
+            ancestor["version"] += 1
+            push_merge(heap, ancestor, counter)
+            ancestor = ancestor["parent"]
+
+    aggregated = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if node["children"]:
+            stack.extend(node["children"])
+        else:
+            aggregated.append(node["network"])
+    return sorted(aggregated), extra_addresses
+
+# Marks the end of a stage's input queue
+_DONE = object()
+
+def lookup_worker(lookup, in_queue, out_queue, seen, seen_lock):
+    while True:
+        item = in_queue.get()
+        if item is _DONE:
+            return
+        # Keep draining the queue even if one item fails, or upstream stages
+        # block on a full queue and the whole run hangs
+        try:
+            result = lookup(item)
+            if not result:
+                continue
+            # Only pass on results we haven't seen yet, so each ASN is fetched once
+            with seen_lock:
+                if result in seen:
+                    continue
+                seen.add(result)
+            out_queue.put(result)
+        except Exception as e:
+            emit(f"echo Error processing {item}: {e}")
+
+def networks_worker(asn_queue, all_ipv4_networks, all_ipv6_networks):
+    last_fetch = None
+    while True:
+        asn = asn_queue.get()
+        if asn is _DONE:
+            return
+        try:
+            # Only wait out whatever is left of radb_delay since the previous query finished
+            if last_fetch is not None:
+                wait = radb_delay - (time.monotonic() - last_fetch)
+                if wait > 0:
+                    emit(f"echo Waiting {wait:.1f} seconds before retrieving next network set")
+                    time.sleep(wait)
+            try:
+                asn_networks = get_networks_from_asn(asn)
+            finally:
+                last_fetch = time.monotonic()
+            if asn_networks:
+                all_ipv4_networks.update(asn_networks["ipv4_networks"])
+                all_ipv6_networks.update(asn_networks["ipv6_networks"])
+        except Exception as e:
+            emit(f"echo Error retrieving networks for ASN {asn}: {e}")
+
+def start_workers(count, target, *args):
+    workers = [threading.Thread(target=target, args=args, daemon=True) for _ in range(count)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+def close_stage(workers, in_queue):
+    for _ in workers:
+        in_queue.put(_DONE)
+    for worker in workers:
+        worker.join()
+
+def run_pipeline(domains, all_ipv4_networks, all_ipv6_networks):
+    domain_queue = queue.Queue(maxsize=queue_size)
+    ip_queue = queue.Queue(maxsize=queue_size)
+    asn_queue = queue.Queue(maxsize=queue_size)
+
+    dns_threads = start_workers(dns_workers, lookup_worker, get_ip_from_domain,
+                                domain_queue, ip_queue, set(), threading.Lock())
+    asn_threads = start_workers(asn_workers, lookup_worker, get_asn_from_ip,
+                                ip_queue, asn_queue, set(), threading.Lock())
+    # RADB fetches stay sequential to respect radb_delay between queries
+    radb_threads = start_workers(1, networks_worker, asn_queue,
+                                 all_ipv4_networks, all_ipv6_networks)
+
+    for domain in domains:
+        domain_queue.put(domain)
+
+    # Shut down each stage once everything upstream of it has finished
+    close_stage(dns_threads, domain_queue)
+    close_stage(asn_threads, ip_queue)
+    close_stage(radb_threads, asn_queue)
+
 def main():
     domains = get_domains_from_file(domains_file)
 
@@ -159,41 +349,23 @@ def main():
         print(f"echo No domains found in {domains_file}. Exiting.")
         sys.exit(1)
 
-    # Get IPs from domains in text file
-    all_ips = set()
-    print(f"echo Performing DNS lookups for all domains...")
-    for domain in domains:
-        ip_address = get_ip_from_domain(domain)
-        if ip_address:
-            all_ips.add(ip_address)
-
-    # Get ASNs from IPs
-    all_asns = set()
-    print(f"echo Finding unique ASNs for all IPs...")
-    for ip_address in all_ips:
-        asn = get_asn_from_ip(ip_address)
-        if asn:
-            all_asns.add(asn)
-
-    # Get all networks from ASNs
     all_ipv4_networks = set()
     all_ipv6_networks = set()
-    print(f"echo Retrieving all networks for the identified ASNs...")
-    for i, asn in enumerate(all_asns):
-        asn_networks = get_networks_from_asn(asn)
-        if asn_networks:
-            all_ipv4_networks.update(asn_networks["ipv4_networks"])
-            all_ipv6_networks.update(asn_networks["ipv6_networks"])
-        if i < len(all_asns) - 1:
-            print(f"echo Waiting 20 seconds before retrieving next network set")
-            time.sleep(20)
+    print(f"echo Resolving domains, ASNs and networks as a streaming pipeline...")
+    run_pipeline(domains, all_ipv4_networks, all_ipv6_networks)
 
     # Aggregate
     print(f"echo Aggregating IP ranges for a more efficient configuration...")
     ipv4_networks = [ipaddress.ip_network(p, strict=False) for p in all_ipv4_networks]
     ipv6_networks = [ipaddress.ip_network(p, strict=False) for p in all_ipv6_networks]
-    collapsed_ipv4 = set(str(net) for net in ipaddress.collapse_addresses(ipv4_networks))
-    collapsed_ipv6 = set(str(net) for net in ipaddress.collapse_addresses(ipv6_networks))
+    aggregated_ipv4, extra_ipv4 = aggregate_networks(ipv4_networks, max_ipv4_entries)
+    aggregated_ipv6, extra_ipv6 = aggregate_networks(ipv6_networks, max_ipv6_entries)
+    if max_ipv4_entries is not None:
+        print(f"echo IPv4 supernet aggregation left {len(aggregated_ipv4)} entries, covering {extra_ipv4} extra addresses")
+    if max_ipv6_entries is not None:
+        print(f"echo IPv6 supernet aggregation left {len(aggregated_ipv6)} entries, covering {extra_ipv6} extra addresses")
+    collapsed_ipv4 = set(str(net) for net in aggregated_ipv4)
+    collapsed_ipv6 = set(str(net) for net in aggregated_ipv6)
 
     # Get current networks from router config
     current_ipv4 = get_current_group_networks(ipv4_group_name, is_ipv6=False)
@@ -3,21 +3,50 @@ import os
 import glob
 import ipaddress
 import subprocess
+import time
 from datetime import datetime, timedelta
 
 #These options are probably fine for any VyOS system
 DOMAINS_FILE = "/config/scripts/vpn_domains_dns.txt"
 OUTPUT_DIR = "/config/groups"
 MASTER_LIST_FILENAME = "vpn-addresses-v4-master.txt"
+# DNS server response times and failure counts, carried over between runs
+DNS_STATS_FILENAME = "dns-server-stats-v4.txt"
 FILE_RETENTION_DAYS = 1
 
 # Maximum gap to bridge when collapsing IP ranges. 0 means only adjacent IPs will be collapsed.
 # 1 will automatically include e.g. 1.1.1.2 if DNS resuls include both 1.1.1.1 and 1.1.1.3
 MAX_IP_RANGE_GAP = 1
 
+# Upstream DNS query tuning
+DIG_TIMEOUT = 10
+# Assumed response time for a server we haven't heard back from yet
+INITIAL_DNS_LATENCY = 0.1
+# Hedge to the next server after this multiple of the fastest healthy server's average response time
+HEDGE_LATENCY_MULTIPLIER = 2
+MIN_HEDGE_DELAY = 0.05
+# A server that fails this many lookups in a row is tried last, until it has gone
+# DNS_FAILURE_RETRY_INTERVAL seconds without failing. It then rejoins the fan-out
+# and its next lookup decides whether it's healthy again.
+MAX_DNS_FAILURES = 3
+DNS_FAILURE_RETRY_INTERVAL = 300
+# Query up to this many healthy servers for every lookup and merge their answers,
+# which picks up more of a CDN's round-robin addresses per run
+DNS_FANOUT = 3
+# After the first answer, wait this long for the other servers before moving on
+DNS_MERGE_WINDOW = 0.5
+
 #CHANGE THESE for your setup
 DIG_PATH = "/usr/bin/dig"
-DNS_SERVER = "10.4.1.2"
+# Upstream DNS servers. Each lookup goes to the fastest healthy server first, then to
+# the other healthy servers (see DNS_FANOUT), and their answers are merged.
+DNS_SERVERS = ["10.4.1.2"]
+
+# Per-server response times, consecutive failure counts and time of last failure,
+# loaded from DNS_STATS_FILENAME at startup and updated as lookups complete
+dns_server_latency = {server: INITIAL_DNS_LATENCY for server in DNS_SERVERS}
+dns_server_failures = {server: 0 for server in DNS_SERVERS}
+dns_server_last_failure = {server: 0.0 for server in DNS_SERVERS}
 
 #This function is only needed when debugging
 # LOG_FILE = "/var/log/dns_update.log" # Use an absolute path for the log file
@@ -53,25 +82,171 @@ def get_domains_from_file(filepath):
 
     return domains
 
+def load_dns_server_stats(directory, filename):
+    filepath = os.path.join(directory, filename)
+    try:
+        with open(filepath, 'r') as f:
+            for line in f:
+                parts = line.split()
+                # Ignore servers that have since been removed from DNS_SERVERS
+                if len(parts) not in (3, 4) or parts[0] not in dns_server_latency:
+                    continue
+                try:
+                    dns_server_latency[parts[0]] = float(parts[1])
+                    dns_server_failures[parts[0]] = int(parts[2])
+                    if len(parts) == 4:
+                        dns_server_last_failure[parts[0]] = float(parts[3])
+                except ValueError:
+                    continue
+        print(f"echo Loaded DNS server stats from {filepath}")
+    except FileNotFoundError:
+        print(f"echo No DNS server stats found at {filepath}, starting fresh.")
+    except IOError as e:
+        print(f"echo Error reading file {filepath}: {e}")
+
+def save_dns_server_stats(directory, filename):
+    filepath = os.path.join(directory, filename)
+    try:
+        with open(filepath, 'w') as f:
+            for server in DNS_SERVERS:
+                f.write(f"{server} {dns_server_latency[server]:.4f} {dns_server_failures[server]} "
+                        f"{dns_server_last_failure[server]:.0f}\n")
+        print(f"echo Saved DNS server stats to {filepath}")
+    except IOError as e:
+        print(f"echo Error writing to file {filepath}: {e}")
+
+def record_dns_success(server, elapsed):
+    # Exponentially weighted average, so recent lookups count for more
+    dns_server_latency[server] = 0.7 * dns_server_latency[server] + 0.3 * elapsed
+    dns_server_failures[server] = 0
+
+def record_dns_failure(server, elapsed):
+    dns_server_latency[server] = max(dns_server_latency[server], elapsed)
+    dns_server_failures[server] += 1
+    dns_server_last_failure[server] = time.time()
+
+def is_dns_server_healthy(server):
+    if dns_server_failures[server] < MAX_DNS_FAILURES:
+        return True
+    return time.time() - dns_server_last_failure[server] >= DNS_FAILURE_RETRY_INTERVAL
+
+def rank_dns_servers():
+    return sorted(DNS_SERVERS, key=lambda server: (
+        not is_dns_server_healthy(server),
+        dns_server_latency[server]
+    ))
+
+def get_hedge_delay(servers):
+    # servers is ranked, so the first one is the fastest healthy server if there is one.
+    # Unhealthy servers can fail quickly and would otherwise make the delay too short.
+    return max(MIN_HEDGE_DELAY, dns_server_latency[servers[0]] * HEDGE_LATENCY_MULTIPLIER)
+
+def stop_dig(process):
+    process.kill()
+    process.wait()
+    process.stdout.close()
+    process.stderr.close()
+
+def start_dig(domain, server):
+    return subprocess.Popen(
+        [DIG_PATH, "+noall", "+answer", "+comments", "A", domain, f"@{server}"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True
+    )
+
+def parse_dig_output(output):
+    # Returns the response status (NOERROR, NXDOMAIN, SERVFAIL...) and any A records
+    status = None
+    ip_addresses = []
+    for line in output.splitlines():
+        if "status:" in line:
+            status = line.split("status:")[1].split(",")[0].strip()
+        elif line and not line.startswith(";"):
+            parts = line.split()
+            if len(parts) >= 5 and parts[3] == "A":
+                ip_addresses.append(parts[4])
+    return status, ip_addresses
+
+def resolve_domain(domain):
+    servers = rank_dns_servers()
+    # The top healthy servers are always queried so their answers can be merged.
+    # Anything further down the list is only a hedge while nobody has answered.
+    healthy = [server for server in servers if is_dns_server_healthy(server)]
+    fanout = max(1, min(DNS_FANOUT, len(healthy)))
+    launched = 0
+    pending = {}
+    ip_addresses = set()
+    answered_by = []
+    next_query_time = time.monotonic()
+    merge_deadline = None
+
+    while True:
+        now = time.monotonic()
+        can_query = launched < len(servers) and (launched < fanout or not answered_by)
+        if not pending and not can_query:
+            break
+
+        # Fastest server goes first, then the next one after the hedge delay or as soon
+        # as an earlier one fails. Once we have an answer, the rest of the fan-out is
+        # queried straight away so it can make the merge deadline.
+        if can_query and (answered_by or now >= next_query_time):
+            server = servers[launched]
+            pending[server] = (start_dig(domain, server), now)
+            launched += 1
+            next_query_time = now + get_hedge_delay(servers)
+
+        for server, (process, started) in list(pending.items()):
+            elapsed = now - started
+            if process.poll() is None:
+                if elapsed >= DIG_TIMEOUT:
+                    stop_dig(process)
+                    del pending[server]
+                    record_dns_failure(server, elapsed)
+                    print(f"echo Error: dig command for {domain} via {server} timed out.")
+                elif merge_deadline is not None and now >= merge_deadline:
+                    # Too slow to be merged into this lookup
+                    stop_dig(process)
+                    del pending[server]
+                    dns_server_latency[server] = max(dns_server_latency[server], elapsed)
+                continue
+
+            stdout, stderr = process.communicate()
+            del pending[server]
+            status, answer = parse_dig_output(stdout)
+            # NXDOMAIN, or NOERROR with no records, is a valid answer about the domain
+            # rather than a problem with the server
+            if process.returncode == 0 and status in ("NOERROR", "NXDOMAIN"):
+                record_dns_success(server, elapsed)
+                ip_addresses.update(answer)
+                answered_by.append(server)
+                if merge_deadline is None:
+                    merge_deadline = now + DNS_MERGE_WINDOW
+            else:
+                # Transport errors, SERVFAIL and REFUSED count against the server
+                record_dns_failure(server, elapsed)
+                if process.returncode != 0:
+                    print(f"echo Error resolving {domain} IPv4 with dig via {server}: {stderr.strip() or stdout.strip()}")
+                else:
+                    print(f"echo Error resolving {domain} IPv4 with dig via {server}: {status}")
+                # Don't wait out the hedge delay when the server has already failed
+                next_query_time = now
+
+        time.sleep(0.01)
+
+    return ip_addresses, answered_by
+
 def get_ips_for_domains(domain_list):
     all_ips = set()
     for domain in domain_list:
-        try:
-            result = subprocess.run(
-                [DIG_PATH, "+short", "A", domain, f"@{DNS_SERVER}"],
-                capture_output=True,
-                text=True,
-                check=True,
-                timeout=10
-            )
-            ip_addresses = [ip.strip() for ip in result.stdout.split('\n') if ip.strip()]
-            for ip in ip_addresses:
-                all_ips.add(ip)
-            print(f"echo Successfully resolved {domain} IPv4 IPs via dig: {' '.join(ip_addresses)}")
-        except subprocess.CalledProcessError as e:
-            print(f"echo Error resolving {domain} IPv4 with dig: {e}")
-        except subprocess.TimeoutExpired:
-            print(f"echo Error: dig command for {domain} timed out.")
+        ip_addresses, answered_by = resolve_domain(domain)
+        if answered_by and not ip_addresses:
+            print(f"echo No IPv4 addresses found for {domain}")
+        elif answered_by:
+            all_ips.update(ip_addresses)
+            print(f"echo Successfully resolved {domain} IPv4 IPs via dig ({' '.join(answered_by)}): {' '.join(sorted(ip_addresses))}")
+        else:
+            print(f"echo Error: could not resolve {domain} IPv4 via any DNS server.")
 
     return all_ips
 
@@ -205,9 +380,12 @@ def main():
 
     domains_to_resolve = get_domains_from_file(DOMAINS_FILE)
 
+    load_dns_server_stats(OUTPUT_DIR, DNS_STATS_FILENAME)
+
     current_dns_ips = get_ips_for_domains(domains_to_resolve)
 
     os.makedirs(OUTPUT_DIR, exist_ok=True)
+    save_dns_server_stats(OUTPUT_DIR, DNS_STATS_FILENAME)
     timestamp = datetime.now().strftime("%Y-%m-%d-%H-%M")
     current_filename = f"vpn-addresses-v4-{timestamp}.txt"
     write_ips_to_file(current_dns_ips, OUTPUT_DIR, current_filename)